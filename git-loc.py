@@ -1,9 +1,17 @@
 #!/usr/bin/env python
 import os
+import re
 import csv
 import json
+import pickle
+import hashlib
+import threading
+import subprocess
 from pathlib import Path
-from collections import defaultdict
+from itertools import chain, islice
+from contextlib import suppress
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from mimetypes import guess_type
 
 from rich import print
@@ -11,45 +19,176 @@ from rich.table import Table
 from git import Repo, Blob
 from tqdm import tqdm
 import rich_click as click
-from ruamel import yaml
 
 BASE = Path(__file__).resolve().parent
-LANGS = yaml.safe_load((BASE / 'languages.yml').open())
 COLS = ('files', 'lines', 'blanks', 'bytes')
+# Slots of the columns in the per group counts
+FILES, LINES, BLANKS, BYTES = range(len(COLS))
 GROUPS = ('extension', 'mime-type', 'language')
 FMTS = ('table', 'csv', 'json', 'yaml')
-totals = {'total': defaultdict(int)}
-config = {'groupby': 'language', 'rev': None, 'working-dir': os.getcwd(), 'fmt': 'table'}
-_lang_cache = {}
+LANGFILES = ('languages.yml', 'heuristics.yml')
+# Blobs per worker task, and shas queued ahead of the one being read from cat-file
+BATCH = 256
+WINDOW = 32
+CHUNK = 65536
+HEAD = 512
+# Leading bytes checked for a NUL to tell binary blobs apart, as git itself does
+PROBE = 8192
+# Flat lookups of filename and extension to language, filled in by `loadlangs`
+_NAME_TO_LANG = {}
+_EXT_TO_LANG = {}
+# Matches extensions made of several suffixes, like `.cmake.in`, at the end of a file name
+_COMPOUND_RE = None
+# Content rules for extensions shared by several languages, as `(language, pattern)` pairs tried in order
+_HEURISTICS = {}
+_sniff_cache = {}
+totals = {'total': [0] * len(COLS)}
+_local = threading.local()
+_catfiles = []
+config = {'groupby': 'language', 'rev': None, 'working-dir': os.getcwd(), 'fmt': 'table', 'cache': True}
+# Whitespace other than newlines, and a table mapping every other byte but the newline to `x`
+_SPACES = b' \t\r\f\v'
+_MARKS = bytes(c if c == ord('\n') else ord('x') for c in range(256))
+# One `<mode> <type> <sha>\t<path>` record of `git ls-tree -r -z`
+_TREE_RE = re.compile(rb'\d+ (\w+) ([0-9a-f]+)\t([^\0]*)\0')
+# One `:<mode> <mode> <sha> <sha> <status>` record and path of `git diff-tree -r -z`, capturing the new side
+_DIFF_RE = re.compile(rb':\d+ (\d+) [0-9a-f]+ ([0-9a-f]+) ([A-Z])\d*\0([^\0]*)\0')
 
 click.rich_click.USE_MARKDOWN = True
 
 
-def getlang(path):
+def parselangs(languages, heuristics):
+    """
+    The `parselangs` function parses `languages.yml` and `heuristics.yml` down to the few fields the
+    language lookups use. Everything else in the files, like colors and scopes, is dropped.
+
+    Args:
+      languages: The raw content of `languages.yml`.
+      heuristics: The raw content of `heuristics.yml`.
+
+    Returns:
+      a tuple of `(names, exts, rules)` dicts mapping filenames and extensions to languages, and
+    ambiguous extensions to their `(language, pattern)` rules with patterns left uncompiled.
+    """
+    from ruamel import yaml
+
+    names, exts, rules = {}, {}, {}
+    # The first listed language wins
+    for name, info in yaml.safe_load(languages).items():
+        for filename in info.get('filenames', []):
+            names.setdefault(filename, name)
+        for ext in info.get('extensions', []):
+            exts.setdefault(ext, name)
+    for entry in yaml.safe_load(heuristics)['disambiguations']:
+        patterns = []
+        for rule in entry['rules']:
+            pattern = rule.get('pattern')
+            if isinstance(pattern, list):
+                pattern = '|'.join(pattern)
+            patterns.append((rule['language'], pattern))
+        for ext in entry['extensions']:
+            rules[ext] = patterns
+    return names, exts, rules
+
+
+def loadlangs():
+    """
+    The `loadlangs` function fills the language lookups from `languages.yml` and `heuristics.yml`.
+    Parsing them takes about a second, so it is only done once a scan needs languages, and the
+    parsed lookups are cached along with the `stamp` they were parsed under.
+    """
+    global _COMPOUND_RE
+
+    if _EXT_TO_LANG:
+        return
+    path = cachedir() / 'languages.pickle'
+    cache = loadcache(path) if config['cache'] else {}
+    if cache.get('stamp') != stamp():
+        cache = {'stamp': stamp(), 'langs': parselangs(*((BASE / name).read_bytes() for name in LANGFILES))}
+        if config['cache']:
+            savecache(path, cache)
+    names, exts, rules = cache['langs']
+    _NAME_TO_LANG.update(names)
+    _EXT_TO_LANG.update(exts)
+    # `splitname` only sees the last suffix, so look for the longer extensions in a single match
+    compound = sorted((ext for ext in exts if ext.count('.') > 1), key=len, reverse=True)
+    _COMPOUND_RE = re.compile('(?:%s)$' % '|'.join(map(re.escape, compound)))
+    for ext, patterns in rules.items():
+        _HEURISTICS[ext] = [(lang, re.compile(p.encode(), re.M) if p else None) for lang, p in patterns]
+
+
+def splitname(path):
+    """
+    The `splitname` function splits a `/` separated path into its file name and extension, following
+    the rules of `Path.name` and `Path.suffix` without building a `Path` object per file.
+
+    Args:
+      path: The path of a file as a string.
+
+    Returns:
+      a tuple of `(name, suffix)`. The suffix includes the leading dot and is empty if the name has no
+    extension, e.g. for `Makefile` or `.gitignore`.
+    """
+    name = path[path.rfind('/') + 1:]
+    i = name.rfind('.')
+    return name, name[i:] if 0 < i < len(name) - 1 else ''
+
+
+def getlang(path, head=b''):
     """
     The function `getlang` returns the programming language of a given file based on its name and
     extension, or returns 'other' if the language is not recognized.
 
     Args:
-      path: The `path` parameter is a file `Path` object that represents the path to a file.
+      path: The `path` parameter is a string that represents the path to a file.
+      head: The first bytes of the file, used to tell apart languages that share an extension.
 
     Returns:
-      the language of a given file path. If the file path matches any of the filenames or extensions
-    specified in the LANGS dictionary, the corresponding language name is returned. If no match is
-    found, 'other' is returned.
+      the language of a given file path. If the file name matches any of the filenames specified in
+    languages.yml, or failing that its extension matches any of the extensions, the
+    corresponding language name is returned. Extensions made of several suffixes take precedence
+    over the last suffix alone. If no match is found, 'other' is returned.
     """
-    global _lang_cache
-
-    if path.name in _lang_cache:
-        return _lang_cache[path.name]
-    for name, info in LANGS.items():
-        if path.name in info.get('filenames', []) or path.suffix in info.get('extensions', []):
-            _lang_cache[path.name] = name
-            return name
-    return 'other'
+    name, suffix = splitname(path)
+    lang = _NAME_TO_LANG.get(name)
+    if lang:
+        return lang
+    if name.count('.') > 1:
+        match = _COMPOUND_RE.search(name)
+        if match:
+            return _EXT_TO_LANG[match.group()]
+    if suffix in _HEURISTICS:
+        return sniff(suffix, head)
+    return _EXT_TO_LANG.get(suffix, 'other')
+
+
+def sniff(ext, head):
+    """
+    The function `sniff` picks the language of a file with an ambiguous extension by matching the
+    heuristics for that extension against the start of its content. Results are memoized on the
+    extension and a digest of the content so repeated headers are only matched once.
 
+    Args:
+      ext: The file extension, including the leading dot.
+      head: The first bytes of the file.
 
-def group(path):
+    Returns:
+      the language of the first matching heuristic rule, or the first language listing the extension
+    if none match.
+    """
+    key = (ext, hashlib.blake2b(head, digest_size=8).digest())
+    lang = _sniff_cache.get(key)
+    if lang is None:
+        for lang, pattern in _HEURISTICS[ext]:
+            if pattern is None or pattern.search(head):
+                break
+        else:
+            lang = _EXT_TO_LANG.get(ext, 'other')
+        _sniff_cache[key] = lang
+    return lang
+
+
+def group(path, head=b''):
     """
     The `group` function takes a file path as input and returns a grouping value based on the
     configuration settings.
@@ -57,6 +196,7 @@ def group(path):
     Args:
       path: The `path` parameter is a string that represents the file path of the file that needs to be
     grouped.
+      head: The first bytes of the file, passed on to `getlang`.
 
     Returns:
       The function `group` returns a grouping value based on the configuration settings. The specific
@@ -66,43 +206,323 @@ def group(path):
     """
     global config
 
-    path = Path(path)
     if config['groupby'] == 'extension':
-        return path.suffix[1:] if path.suffix else 'other'
+        return splitname(path)[1][1:] or 'other'
     elif config['groupby'] == 'mime-type':
         mimetype = guess_type(path)
         return mimetype[0] if mimetype[0] else Blob.DEFAULT_MIME_TYPE
     elif config['groupby'] == 'language':
-        return getlang(path)
+        return getlang(path, head)
+
+
+def chunks(stream, size):
+    """
+    The `chunks` function reads `size` bytes from a stream in fixed size blocks.
+
+    Args:
+      stream: A binary file object to read from.
+      size: The number of bytes to read.
+
+    Returns:
+      a generator of `bytes` blocks of at most `CHUNK` bytes each.
+    """
+    while size:
+        block = stream.read(min(size, CHUNK))
+        if not block:
+            break
+        size -= len(block)
+        yield block
+
+
+def count(blocks):
+    """
+    The `count` function counts the lines and blank lines in a blob a block at a time, without
+    splitting it into per-line objects.
+
+    Args:
+      blocks: An iterable of the raw `bytes` blocks of a blob, in order.
+
+    Returns:
+      a tuple of `(lines, blanks)` where `blanks` is the number of whitespace-only lines and `lines`
+    includes them. A final line without a trailing newline is counted as well.
+    """
+    lines = blanks = 0
+    # Whether the line running on from the previous block has any non-blank content
+    dirty = False
+    ended = True
+    for block in blocks:
+        if not block:
+            continue
+        # Drop whitespace and mark everything else, so a non-blank line ends in `x\n`
+        marks = block.translate(_MARKS, _SPACES)
+        newlines = marks.count(b'\n')
+        if newlines:
+            nonblank = marks.count(b'x\n') + (dirty and marks.startswith(b'\n'))
+            lines += newlines
+            blanks += newlines - nonblank
+            dirty = marks.endswith(b'x')
+        elif marks:
+            dirty = True
+        ended = block.endswith(b'\n')
+    if not ended:
+        lines += 1
+        if not dirty:
+            blanks += 1
+    return lines, blanks
+
+
+def catfile():
+    """
+    The `catfile` function returns the `git cat-file --batch` process of the current thread, starting
+    one on first use. A batch process answers one request at a time so each worker needs its own.
+    """
+    proc = getattr(_local, 'catfile', None)
+    if proc is None:
+        cmd = ['git', '-C', config['working-dir'], 'cat-file', '--batch']
+        proc = _local.catfile = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        _catfiles.append(proc)
+    return proc
+
+
+@lru_cache(maxsize=None)
+def stamp():
+    """
+    The `stamp` function returns a digest of this script and the language data. Anything cached is
+    only valid for the stamp it was written under.
+    """
+    sources = [Path(__file__).resolve()] + [BASE / name for name in LANGFILES]
+    return hashlib.blake2b(b''.join(source.read_bytes() for source in sources), digest_size=8).digest()
+
+
+def cachedir():
+    """
+    The `cachedir` function returns the directory the caches are kept in, under the user cache
+    directory.
+    """
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'git-loc'
+
+
+def cachefile(repo):
+    """
+    The `cachefile` function returns the path of the results cache for a repository, named after a
+    digest of the repository's git dir.
+    """
+    key = hashlib.blake2b(os.fsencode(os.path.abspath(repo.git_dir)), digest_size=8).hexdigest()
+    return cachedir() / f'{key}.pickle'
+
+
+def loadcache(path):
+    """
+    The `loadcache` function reads a results cache written by `savecache`, returning an empty cache
+    if it is missing or unreadable.
+    """
+    try:
+        with path.open('rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Truncated or foreign pickles can fail in many ways, any of them is just a cache miss
+        return {}
+
+
+def savecache(path, cache):
+    """
+    The `savecache` function atomically writes the results cache so concurrent runs never see a
+    partial file. A cache that can't be written only warns, it never fails the run.
+    """
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tmp.open('wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        click.echo(f'Could not write cache {path}: {e}', err=True)
+        with suppress(OSError):
+            tmp.unlink()
+
+
+def blobs(sha):
+    """
+    The `blobs` function lists every blob in a tree with a single `git ls-tree` call.
+
+    Args:
+      sha: The sha of the tree to list.
+
+    Returns:
+      a list of `(sha, path)` tuples, one per blob in the tree.
+    """
+    cmd = ['git', '-C', config['working-dir'], 'ls-tree', '-r', '-z', sha]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+    return [(sha, os.fsdecode(path)) for kind, sha, path in _TREE_RE.findall(out) if kind == b'blob']
+
+
+def changes(old, new, records):
+    """
+    The `changes` function compares two trees with a single `git diff-tree` call. Records of paths
+    that were deleted or modified are dropped.
+
+    Args:
+      old: The sha of the tree the records were counted from.
+      new: The sha of the tree to bring the records up to date with.
+      records: The per path counts of the old tree, updated in place.
+
+    Returns:
+      a list of `(sha, path)` tuples of the blobs that were added or modified and need scanning.
+    """
+    cmd = ['git', '-C', config['working-dir'], 'diff-tree', '-r', '-z', '--no-renames', old, new]
+    out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    items = []
+    for mode, sha, status, path in _DIFF_RE.findall(out):
+        path = os.fsdecode(path)
+        records.pop(path, None)
+        # Submodules show up as commits rather than blobs
+        if status != b'D' and mode != b'160000':
+            items.append((sha, path))
+    return items
+
+
+def scan(batch):
+    """
+    The `scan` function reads a batch of git blobs and counts their lines. It does not touch any
+    shared state so it can run on a worker thread.
+
+    Args:
+      batch: A list of `(sha, path)` tuples of the blobs to read.
+
+    Returns:
+      a list of `(path, group, bytes, lines, blanks)` tuples, one per blob.
+    """
+    proc = catfile()
+    try:
+        return scanbatch(proc, batch)
+    except BaseException:
+        # The rest of the batch is still queued in the pipe, so the process can't be reused or waited on
+        _local.catfile = None
+        _catfiles.remove(proc)
+        proc.kill()
+        proc.wait()
+        raise
+
+
+def scanbatch(proc, batch):
+    """
+    The `scanbatch` function does the work of `scan` through a given `git cat-file --batch` process.
+    """
+    # Keep a window of shas queued ahead so git streams the blobs back to back instead of waiting on a
+    # round trip per blob. The window stays well under the smallest pipe buffer (4KB on Windows, or a
+    # single page once Linux limits pipes), otherwise we could block writing shas while git blocks
+    # writing bodies we haven't read yet.
+    queue = iter(batch)
+    proc.stdin.write(b''.join(sha + b'\n' for sha, path in islice(queue, WINDOW)))
+    proc.stdin.flush()
+    results = []
+    for sha, path in batch:
+        # Raw blob data is sent after a `<sha> blob <size>` header and followed by a newline
+        header = proc.stdout.readline()
+        fields = header.split()
+        if len(fields) != 3 or fields[1] != b'blob':
+            raise click.ClickException(f'Could not read blob {sha.decode()} for {path}, git replied {header!r}')
+        size = int(fields[2])
+        blocks = chunks(proc.stdout, size)
+        head = next(blocks, b'')
+        if b'\0' in head[:PROBE]:
+            # Binary blobs still count towards files and bytes but have no lines, just drain them
+            lines = blanks = 0
+            for block in blocks:
+                pass
+        else:
+            lines, blanks = count(chain((head,), blocks))
+        proc.stdout.read(1)
+        # Top the window back up now that a body has left the pipe
+        ahead = next(queue, None)
+        if ahead:
+            proc.stdin.write(ahead[0] + b'\n')
+            proc.stdin.flush()
+        results.append((path, group(path, head[:HEAD]), size, lines, blanks))
+    return results
 
 
 def tree(repo):
     """
     The `tree` function iterates through the items in a repository's tree, analyzes the git blobs
-    and accumulates the counts by group and totals.
+    in batches on a thread pool and accumulates the counts by group and totals.
+
+    Per path counts are cached by tree sha, so a repeated run over the same tree reads no blobs and a
+    run over a different tree only reads the blobs that changed since the cached one.
     """
     global totals
 
-    # Just traverse the unique set of Blobs for a given tree
-    items = list(repo.tree(config['rev']).traverse(lambda i, d: isinstance(i, Blob), visit_once=True))
-    for item in tqdm(items):
-        ext = group(item.path)
-        totals.setdefault(ext, defaultdict(int))
-        totals[ext]['files'] += 1
-        totals['total']['files'] += 1
-        totals[ext]['bytes'] += item.size
-        totals['total']['bytes'] += item.size
-        # Read raw blob data from the index
-        for line in item.data_stream.stream.readlines():
-            k = 'blanks' if line.isspace() else 'lines'
-            totals[ext][k] += 1
-            totals['total'][k] += 1
+    cmd = ['git', '-C', config['working-dir'], 'rev-parse', '--verify', f"{config['rev'] or 'HEAD'}^{{tree}}"]
+    sha = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout.strip()
+    path = cachefile(repo)
+    cache = loadcache(path) if config['cache'] else {}
+    # Counts depend on this script and the language data, so drop them once either changes
+    if cache.get('stamp') != stamp():
+        cache = {'stamp': stamp()}
+    cached, records = cache.get(config['groupby'], (None, {}))
+    if cached == sha:
+        items = []
+    elif cached:
+        try:
+            items = changes(cached, sha, records)
+        except subprocess.CalledProcessError:
+            # The cached tree is gone, e.g. garbage collected
+            records = {}
+            items = blobs(sha)
+    else:
+        items = blobs(sha)
+
+    if items and config['groupby'] == 'language':
+        loadlangs()
+    # Hand out fixed size batches so the pool only tracks a future per batch rather than per blob
+    batches = [items[i:i + BATCH] for i in range(0, len(items), BATCH)]
+    try:
+        with tqdm(total=len(items)) as progress, ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            try:
+                for results in executor.map(scan, batches):
+                    for name, *counts in results:
+                        records[name] = counts
+                    progress.update(len(results))
+            except BaseException:
+                # Report a failed batch right away rather than after scanning everything else
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        while _catfiles:
+            proc = _catfiles.pop()
+            proc.stdin.close()
+            # Closing stdout too means git can't stay blocked writing output nobody will read
+            proc.stdout.close()
+            proc.wait()
+    if config['cache'] and cached != sha:
+        cache[config['groupby']] = (sha, records)
+        savecache(path, cache)
+
+    for ext, size, lines, blanks in records.values():
+        ent = totals.get(ext)
+        if ent is None:
+            ent = totals[ext] = [0] * len(COLS)
+        ent[FILES] += 1
+        ent[BYTES] += size
+        ent[LINES] += lines - blanks
+        ent[BLANKS] += blanks
+    # Sum the groups once rather than updating the total for every blob
+    groups = [counts for ext, counts in totals.items() if ext != 'total']
+    totals['total'] = [sum(column) for column in zip(totals['total'], *groups)]
 
 
 def fmtint(value):
     return f'{value:,}'
 
 
+def rows():
+    """
+    The `rows` function flattens the totals into `(group, files, lines, blanks, bytes)` tuples in one
+    pass, sorted by line count, for the table and csv output.
+    """
+    return sorted(((ext, *counts) for ext, counts in totals.items()), key=lambda x: x[1 + LINES])
+
+
 def fmttotals(repo):
     global config, totals
 
@@ -112,24 +532,25 @@ def fmttotals(repo):
     if fmt == 'table':
         header = (config['groupby'],) + COLS
         table = Table(*header, title=f'File Line Counts\n{wdir}', show_header=True, header_style='bold magenta')
-        for ext, counts in sorted(totals.items(), key=lambda x: x[1]['lines']):
-            table.add_row(ext, *[fmtint(counts[col]) for col in COLS])
+        for ext, *counts in rows():
+            table.add_row(ext, *map(fmtint, counts))
         print(table)
         return
     outfile = wdir / f'git-line-totals.{fmt}'
     if fmt == 'csv':
         header = (config['groupby'],) + COLS
-        rows = [[ext] + [counts[col] for col in COLS] for ext, counts in totals.items()]
         with outfile.open('w') as f:
             writer = csv.writer(f)
             writer.writerow(header)
-            writer.writerows(sorted(rows, key=lambda x: x[1]))
+            writer.writerows(rows())
     elif fmt == 'json':
         with outfile.open('w') as f:
-            json.dump(totals, f, indent=2, sort_keys=True)
+            json.dump({key: dict(zip(COLS, counts)) for key, counts in totals.items()}, f, indent=2, sort_keys=True)
     elif fmt == 'yaml':
+        from ruamel import yaml
+
         with outfile.open('w') as f:
-            yaml.dump({key: dict(counts) for key, counts in totals.items()}, f, default_flow_style=False)
+            yaml.dump({key: dict(zip(COLS, counts)) for key, counts in totals.items()}, f, default_flow_style=False)
     print(f'Wrote report to {outfile}')
 
 
@@ -142,7 +563,8 @@ def fmttotals(repo):
     '-g', '--groupby', default=config['groupby'], type=click.Choice(GROUPS), help='Group results by language, mime type or file extension'
 )
 @click.option('-f', '--format', 'fmt', default=config['fmt'], type=click.Choice(FMTS))
-def cli(working_dir, rev, groupby, fmt):
+@click.option('--cache/--no-cache', default=config['cache'], help='Reuse and update the results cache in ~/.cache/git-loc')
+def cli(working_dir, rev, groupby, fmt, cache):
     """
     Generate Git Lines of Code counts for all files in a Git repository.
 
@@ -150,7 +572,7 @@ def cli(working_dir, rev, groupby, fmt):
     It counts
 
     - Number of files
-    - Number of lines
+    - Number of lines, binary files have none
     - Number of blank lines
     - Number of total bytes
 
@@ -162,13 +584,15 @@ def cli(working_dir, rev, groupby, fmt):
 
     `format` option is how to format the output. Defaults to `table` which prints the results in a table. Also supports csv, json or yaml
 
+    `cache` option is whether to reuse the counts of earlier runs, kept per repository in `~/.cache/git-loc` (or `$XDG_CACHE_HOME/git-loc` when set). Defaults to on, so repeated runs only read blobs that changed since the last one. `--no-cache` also skips the cached language data
+
     Example:
 
     `$ git-loc.py /path/to/repo -r main -f yaml`
     """
     global config
 
-    config.update({'working-dir': working_dir, 'rev': rev, 'groupby': groupby, 'fmt': fmt})
+    config.update({'working-dir': working_dir, 'rev': rev, 'groupby': groupby, 'fmt': fmt, 'cache': cache})
     repo = Repo(working_dir)
     tree(repo)
     fmttotals(repo)